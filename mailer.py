@@ -7,7 +7,18 @@ import getpass
 import smtplib
 import csv
 import re
-from time import sleep
+import os
+import sys
+import json
+import queue
+import signal
+import threading
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import email.generator
+from time import sleep, thread_time
 from collections import namedtuple
 
 # Global setup
@@ -18,6 +29,11 @@ fileBody = "email.txt"
 mailServer = "smtp.example.com"
 mailUser = "robot"
 dryRun = False
+queueDepth = 16
+checkpointFile = "mailer.checkpoint"
+checkpointEvery = 1
+profileMessages = 0
+profileReport = "mailer.profile"
 
 
 class Score(object):
@@ -107,16 +123,12 @@ def compose_body(body_file, results):
     return body
 
 
-def get_results(filename, keyname=None, delimiter=';', quotechar='"'):
+def iter_results(filename, keyname=None, delimiter=';', quotechar='"'):
 
-    """Read results from a CSV file and return as dictionary. If `keyname`
-    is not None, the file is expected to contain column names in the first
-    row, the records are returned as dictionaries and the indicated
-    column `keyname` is used as an unique key. Otherwise, the first column
-    is used as an unique key, and the remaining fields are returned
-    as list."""
+    """Read results from a CSV file one row at a time and yield
+    (key, record) pairs in file order. The meaning of `keyname` is the
+    same as in `get_results`. Only the current row is kept in memory."""
 
-    results = {}
     with open(filename) as fp:
         if keyname:
             func = csv.DictReader
@@ -135,8 +147,19 @@ def get_results(filename, keyname=None, delimiter=';', quotechar='"'):
                         idx = tmp[1]
                     else:
                         val[tmp[0]] = tmp[1]
-            results[idx] = val
-    return results
+            yield idx, val
+
+
+def get_results(filename, keyname=None, delimiter=';', quotechar='"'):
+
+    """Read results from a CSV file and return as dictionary. If `keyname`
+    is not None, the file is expected to contain column names in the first
+    row, the records are returned as dictionaries and the indicated
+    column `keyname` is used as an unique key. Otherwise, the first column
+    is used as an unique key, and the remaining fields are returned
+    as list."""
+
+    return dict(iter_results(filename, keyname, delimiter, quotechar))
 
 
 MType = namedtuple('MType', ['type', 'encoding', 'maintype', 'subtype'])
@@ -279,20 +302,442 @@ class Sender(object):
             return msg.as_string()
 
 
+class Checkpoint(object):
+    """Keep track of the progress of a run and store it in a JSON file.
+
+    The file holds the key of the last record that was sent and the
+    number of records read, rendered and sent. If the file exists when
+    the object is created, the state is restored from it, so that
+    an interrupted run can be resumed. With `filename` set to None
+    the progress is only kept in memory.
+
+    `run` is a dictionary identifying the run, e.g. the input file and
+    whether it is a dry run. It is stored in the file and a checkpoint
+    written for a different run is rejected with RuntimeError."""
+
+    def __init__(self, filename=None, every=10, run=None):
+
+        self.filename = filename
+        self.every = every
+        self.run = run if run else {}
+        self.last_key = None
+        self.counts = {'read': 0, 'rendered': 0, 'sent': 0}
+        self._pending = 0
+        if filename and os.path.exists(filename):
+            with open(filename) as fp:
+                state = json.load(fp)
+            if state.get('run', {}) != self.run:
+                raise RuntimeError(
+                    "Checkpoint {} was written for {}, not {}".format(
+                        filename, state.get('run', {}), self.run))
+            self.last_key = state['last_key']
+            self.counts.update(state['counts'])
+
+    def count(self, stage):
+        self.counts[stage] += 1
+
+    def commit(self, key):
+        """Mark the record `key` as sent and save the state
+        every `every` commits."""
+
+        self.last_key = key
+        self.count('sent')
+        self._pending += 1
+        if self._pending >= self.every:
+            self.save()
+
+    def save(self):
+        """Write the state to a temporary file first and move it
+        in place, so the checkpoint is never left half-written."""
+
+        self._pending = 0
+        if not self.filename:
+            return
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump({'run': self.run, 'last_key': self.last_key,
+                       'counts': self.counts}, fp)
+        os.replace(tmpname, self.filename)
+
+
+class RunLoop(object):
+    """Pass records through the read, render and send stages.
+
+    `records` is an iterable of (key, record) pairs, e.g. the output of
+    `iter_results`. `render(key, record)` returns the message and
+    `send(key, message)` delivers it. Reading and rendering run in
+    background threads, sending runs in the calling thread. The stages
+    are connected by queues holding at most `depth` items, so a slow
+    server blocks the readers instead of growing the memory usage.
+
+    On SIGINT or SIGTERM no more records are read, but the ones already
+    queued are rendered and sent before `run` returns, and `interrupted`
+    is set if some records were left unread. A second signal raises
+    KeyboardInterrupt, after the checkpoint is saved. The progress is recorded in `checkpoint`;
+    if it already has a `last_key`, all records up to and including
+    that key are skipped, which requires the records to come in the
+    same order as in the interrupted run. If the key is not found
+    at all, nothing is sent and `run` raises RuntimeError."""
+
+    _done = object()
+
+    def __init__(self, records, render, send, depth=16, checkpoint=None):
+
+        self.records = records
+        self.render = render
+        self.send = send
+        self.checkpoint = checkpoint if checkpoint else Checkpoint()
+        self.to_render = queue.Queue(maxsize=depth)
+        self.to_send = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.interrupted = False
+        self._aborted = threading.Event()
+        self._error = None
+
+    def stop(self, signum=None, frame=None):
+        """Stop reading new records and let the queues drain"""
+
+        self.stopping.set()
+        if signum is not None:
+            signal.signal(signum, self._interrupt)
+
+    def _interrupt(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def _put(self, q, item):
+        while not self._aborted.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._aborted.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self._done
+
+    def _stage(self, func):
+        try:
+            func()
+        except BaseException as e:
+            self._error = e
+            self._aborted.set()
+
+    def _read(self):
+        skip = self.checkpoint.last_key is not None
+        try:
+            for key, record in self.records:
+                if self.stopping.is_set():
+                    self.interrupted = True
+                    break
+                if skip:
+                    skip = key != self.checkpoint.last_key
+                    continue
+                self.checkpoint.count('read')
+                if not self._put(self.to_render, (key, record)):
+                    return
+            if skip and not self.stopping.is_set():
+                raise RuntimeError(
+                    "Checkpoint key {} not found in the records".format(
+                        self.checkpoint.last_key))
+        finally:
+            self._put(self.to_render, self._done)
+
+    def _render(self):
+        try:
+            while True:
+                item = self._get(self.to_render)
+                if item is self._done:
+                    break
+                key, record = item
+                msg = self.render(key, record)
+                self.checkpoint.count('rendered')
+                if not self._put(self.to_send, (key, msg)):
+                    return
+        finally:
+            self._put(self.to_send, self._done)
+
+    def _install_handlers(self):
+        self._handlers = {}
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._handlers[signum] = signal.signal(signum, self.stop)
+
+    def _restore_handlers(self):
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+
+    def run(self):
+        """Process all the records and return the checkpoint"""
+
+        threads = [
+            threading.Thread(target=self._stage, args=(self._read,),
+                             daemon=True),
+            threading.Thread(target=self._stage, args=(self._render,),
+                             daemon=True)]
+        self._install_handlers()
+        try:
+            for t in threads:
+                t.start()
+            while True:
+                item = self._get(self.to_send)
+                if item is self._done:
+                    break
+                key, msg = item
+                self.send(key, msg)
+                self.checkpoint.commit(key)
+        except BaseException:
+            self._aborted.set()
+            raise
+        finally:
+            self._restore_handlers()
+            self.checkpoint.save()
+            for t in threads:
+                t.join()
+        if self._error is not None:
+            raise self._error
+        return self.checkpoint
+
+
+def _text_size(args, kwargs, result):
+    return len(result.encode('utf-8')) if result else 0
+
+
+def _html_size(args, kwargs, result):
+    return len(result[0].encode('utf-8')) if result else 0
+
+
+def _message_size(args, kwargs, result):
+    msg = kwargs.get('msg', args[1] if len(args) > 1 else None)
+    return len(msg.as_bytes()) if msg else 0
+
+
+class Profiler(object):
+    """Measure where the time goes when composing and sending messages.
+
+    While active, `compose_body`, `Message.__init__`,
+    `Message.find_images_in_html`, flattening of messages and
+    `Sender.send` are wrapped and the first `limit` calls of each are
+    measured: CPU time of the calling thread, peak of the memory traced
+    by tracemalloc above the level at the start of the call, and the
+    number of bytes produced (for Sender.send, the size of the flattened
+    message). The call sites which allocated the most memory are
+    recorded as well and, if `use_cprofile` is True, the calls are also
+    run under cProfile. The numbers are inclusive, e.g. Sender.send
+    contains the flattening of the message.
+
+    Measured calls hold a lock, so they do not overlap each other, but
+    tracemalloc traces the whole process: memory allocated at the same
+    time by other threads, e.g. the reader of RunLoop, is included in
+    the peaks and the call sites.
+
+    Once Sender.send, or every stage, has been measured `limit` times,
+    the stages are unwrapped and tracing is stopped, so the rest of the
+    run is not slowed down. On exit, the report is written to the file
+    `report`, or to stdout if it is None. With `limit` equal to 0
+    the profiler does nothing."""
+
+    top = 10
+
+    def __init__(self, limit=10, report=None, use_cprofile=True):
+
+        self.limit = limit
+        self.report = report
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+        self.stages = [
+            ('compose_body', sys.modules[__name__], 'compose_body',
+             _text_size),
+            ('Message.__init__', Message, '__init__', None),
+            ('find_images_in_html', Message, 'find_images_in_html',
+             _html_size),
+            ('flatten', email.generator.Generator, 'flatten', None),
+            ('Sender.send', Sender, 'send', _message_size),
+        ]
+        self.stats = {}
+        self.sites = {}
+        self._originals = []
+        self._closed = False
+        self._filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        if not self.limit:
+            return self
+        self._started_tracing = not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+        for name, owner, attr, size in self.stages:
+            self.stats[name] = {'calls': 0, 'cpu': 0.0, 'peak': 0,
+                                'bytes': 0}
+            func = getattr(owner, attr)
+            self._originals.append((owner, attr, func))
+            setattr(owner, attr, self._wrap(name, func, size))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.limit:
+            return
+        self._close()
+        try:
+            if self.report is None:
+                self.write_report(sys.stdout)
+            else:
+                with open(self.report, 'w') as fp:
+                    self.write_report(fp)
+        except Exception:
+            # do not hide the exception which ended the run
+            if exc_type is None:
+                raise
+
+    def _close(self):
+        """Unwrap the stages and stop tracing"""
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for owner, attr, func in reversed(self._originals):
+                setattr(owner, attr, func)
+            self._originals = []
+            if self._started_tracing:
+                tracemalloc.stop()
+
+    def _sampled(self):
+        if self.stats['Sender.send']['calls'] >= self.limit:
+            return True
+        return all(s['calls'] >= self.limit for s in self.stats.values())
+
+    def _wrap(self, name, func, size):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self._call(name, size, func, args, kwargs)
+
+        return wrapper
+
+    @staticmethod
+    def _update_peaks(frames):
+        """Pass the peak since the last reset to all the calls in
+        progress and reset it, so a nested call can measure its own"""
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in frames:
+            frame['peak'] = max(frame['peak'], peak)
+        tracemalloc.reset_peak()
+
+    def _call(self, name, size, func, args, kwargs):
+        local = self._local.__dict__
+        frames = local.setdefault('frames', [])
+        stats = self.stats[name]
+        if self._closed or local.get('sizing') \
+                or stats['calls'] >= self.limit \
+                or any(frame['name'] == name for frame in frames):
+            return func(*args, **kwargs)
+        with self._lock:
+            if self._closed or stats['calls'] >= self.limit:
+                return func(*args, **kwargs)
+            stats['calls'] += 1
+            outer = not frames
+            if outer:
+                before = tracemalloc.take_snapshot()
+                if self.cprofile:
+                    self.cprofile.enable()
+            self._update_peaks(frames)
+            frame = {'name': name, 'peak': 0,
+                     'start': tracemalloc.get_traced_memory()[0]}
+            frames.append(frame)
+            start = thread_time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                stats['cpu'] += thread_time() - start
+                self._update_peaks(frames)
+                frames.pop()
+                stats['peak'] += frame['peak'] - frame['start']
+                if outer:
+                    if self.cprofile:
+                        self.cprofile.disable()
+                    self._record_sites(before)
+            if size:
+                # calls made only to measure the output are not profiled
+                local['sizing'] = True
+                try:
+                    stats['bytes'] += size(args, kwargs, result)
+                finally:
+                    local['sizing'] = False
+            if outer and self._sampled():
+                self._close()
+            return result
+
+    def _record_sites(self, before):
+        after = tracemalloc.take_snapshot().filter_traces(self._filters)
+        before = before.filter_traces(self._filters)
+        for diff in after.compare_to(before, 'lineno'):
+            if diff.size_diff > 0:
+                frame = diff.traceback[0]
+                site = "{}:{}".format(frame.filename, frame.lineno)
+                self.sites[site] = self.sites.get(site, 0) + diff.size_diff
+
+    def write_report(self, fp):
+        """Write per-stage averages, the top allocating call sites and,
+        if enabled, the cProfile statistics to the file object fp"""
+
+        print("{:<20} {:>6} {:>12} {:>14} {:>12}".format(
+            "stage", "calls", "CPU ms/call", "peak B/call", "out B/call"),
+            file=fp)
+        for name, owner, attr, size in self.stages:
+            stats = self.stats[name]
+            calls = stats['calls']
+            if not calls:
+                continue
+            out = "{:.0f}".format(stats['bytes'] / calls) if size else "-"
+            print("{:<20} {:>6} {:>12.3f} {:>14.0f} {:>12}".format(
+                name, calls, 1000 * stats['cpu'] / calls,
+                stats['peak'] / calls, out), file=fp)
+        print("\nTop allocating call sites:", file=fp)
+        sites = sorted(self.sites.items(), key=lambda x: x[1], reverse=True)
+        for site, allocated in sites[:self.top]:
+            print("{:>12} B  {}".format(allocated, site), file=fp)
+        if self.cprofile and any(s['calls'] for s in self.stats.values()):
+            print("\ncProfile, sorted by cumulative time:", file=fp)
+            stats = pstats.Stats(self.cprofile, stream=fp)
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+
 if __name__ == '__main__':
 
     mailPassword = getpass.getpass("Enter mailbox password:")
 
-    data = get_results(testResults, 'ID')
+    def render(student, results):
+        body = compose_body(fileBody, results)
+        to = "%s@student.pwr.edu.pl" % student
+        return Message(emailFrom, to, emailSubject, body)
+
+    with Profiler(profileMessages, profileReport), \
+            Sender(mailServer, mailUser, mailPassword, dryRun) as snd:
 
-    with Sender(mailServer, mailUser, mailPassword, dryRun) as snd:
-        for student, results in data.items():
-            body = compose_body(fileBody, results)
-            to = "%s@student.pwr.edu.pl" % student
-            print("Sending to", to)
-            msg = Message(emailFrom, to, emailSubject, body)
+        def send(student, msg):
+            print("Sending to", msg['To'])
             out = snd.send(msg)
             if out:
                 print(out)
             # let the mail server take a breath
             sleep(2)
+
+        data = iter_results(testResults, 'ID')
+        checkpoint = Checkpoint(checkpointFile, checkpointEvery,
+                                {'results': testResults, 'dry_run': dryRun})
+        loop = RunLoop(data, render, send, queueDepth, checkpoint)
+        loop.run()
+        if loop.interrupted:
+            print("Interrupted after", checkpoint.last_key,
+                  "- run again to resume")
+        else:
+            os.remove(checkpointFile)
@@ -2,12 +2,18 @@ import unittest
 from unittest.mock import patch, call
 import re
 from tempfile import NamedTemporaryFile
-from os import remove
+from os import remove, path
+import json
+import signal
+import tracemalloc
 from random import randint
+from time import sleep
 from base64 import b64decode
 from email import message_from_string
 from mailer import Score, Text, Message, Sender
-from mailer import compose_body, get_results
+from mailer import Checkpoint, RunLoop, Profiler
+import mailer
+from mailer import compose_body, get_results, iter_results
 
 
 def get_attachment(email, filename):
@@ -110,6 +116,12 @@ class TestResults(unittest.TestCase):
                 self.assertTrue(k in record)
                 self.assertEqual(record[k], str(val[i]))
 
+    def test_iter_order(self):
+        """Records should be yielded in the file order"""
+
+        keys = [key for key, val in iter_results(self.filename, 'column 0')]
+        self.assertEqual(keys, [str(row[0]) for row in self.data])
+
     def test_content_list(self):
         """With no keyname, a dictionary of lists should be returned"""
 
@@ -380,5 +392,305 @@ class TestSender(unittest.TestCase):
         self.assertEqual(mock_smtp.mock_calls, expected_calls)
 
 
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        with NamedTemporaryFile(suffix='.checkpoint', delete=False) as fp:
+            self.filename = fp.name
+        remove(self.filename)
+
+    def tearDown(self):
+        if path.exists(self.filename):
+            remove(self.filename)
+
+    def test_save_every(self):
+        cp = Checkpoint(self.filename, every=3)
+        cp.commit('a')
+        cp.commit('b')
+        self.assertFalse(path.exists(self.filename))
+        cp.commit('c')
+        with open(self.filename) as fp:
+            state = json.load(fp)
+        self.assertEqual(state['last_key'], 'c')
+        self.assertEqual(state['counts']['sent'], 3)
+
+    def test_restore(self):
+        cp = Checkpoint(self.filename)
+        cp.count('read')
+        cp.commit('x')
+        cp.save()
+        cp = Checkpoint(self.filename)
+        self.assertEqual(cp.last_key, 'x')
+        self.assertEqual(cp.counts['read'], 1)
+        self.assertEqual(cp.counts['sent'], 1)
+
+    def test_different_run(self):
+        cp = Checkpoint(self.filename, run={'dry_run': True})
+        cp.commit('x')
+        cp.save()
+        with self.assertRaises(RuntimeError):
+            Checkpoint(self.filename, run={'dry_run': False})
+        cp = Checkpoint(self.filename, run={'dry_run': True})
+        self.assertEqual(cp.last_key, 'x')
+
+
+class TestRunLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [(str(i), {'value': i}) for i in range(50)]
+        self.sent = []
+
+    def render(self, key, record):
+        return 'msg {}'.format(record['value'])
+
+    def send(self, key, msg):
+        self.sent.append((key, msg))
+
+    def test_all_sent_in_order(self):
+        cp = RunLoop(self.records, self.render, self.send, depth=2).run()
+        expected = [(k, 'msg {}'.format(v['value'])) for k, v in self.records]
+        self.assertEqual(self.sent, expected)
+        self.assertEqual(cp.last_key, '49')
+        self.assertEqual(cp.counts,
+                         {'read': 50, 'rendered': 50, 'sent': 50})
+
+    def test_bounded_queues(self):
+        """The reader must not run ahead by more than the queue depths
+        plus the items held by the stages"""
+
+        read = []
+
+        def records():
+            for item in self.records:
+                read.append(item[0])
+                yield item
+
+        def send(key, msg):
+            self.assertLessEqual(len(read) - len(self.sent), 2 + 2 + 3)
+            self.sent.append(key)
+
+        RunLoop(records(), self.render, send, depth=2).run()
+        self.assertEqual(len(self.sent), len(self.records))
+
+    def test_resume(self):
+        cp = Checkpoint()
+        cp.last_key = '19'
+        RunLoop(self.records, self.render, self.send, checkpoint=cp).run()
+        self.assertEqual([k for k, m in self.sent],
+                         [k for k, v in self.records[20:]])
+
+    def test_resume_key_missing(self):
+        cp = Checkpoint()
+        cp.last_key = 'gone'
+        with self.assertRaises(RuntimeError):
+            RunLoop(self.records, self.render, self.send,
+                    checkpoint=cp).run()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(cp.last_key, 'gone')
+
+    def test_stop_drains(self):
+        """After a stop request nothing new is read, but everything
+        already read is sent"""
+
+        def send(key, msg):
+            if key == '5':
+                loop.stop()
+            self.sent.append(key)
+
+        loop = RunLoop(self.records, self.render, send, depth=2)
+        cp = loop.run()
+        self.assertTrue(loop.interrupted)
+        self.assertLess(len(self.sent), len(self.records))
+        self.assertEqual(cp.counts['read'], len(self.sent))
+        self.assertEqual(cp.last_key, self.sent[-1])
+
+    def test_stop_after_reading(self):
+        """A stop request after all the records were read does not
+        interrupt the run"""
+
+        def send(key, msg):
+            if key == '49':
+                loop.stop()
+            self.sent.append(key)
+
+        loop = RunLoop(self.records, self.render, send, depth=2)
+        loop.run()
+        self.assertTrue(loop.stopping.is_set())
+        self.assertFalse(loop.interrupted)
+        self.assertEqual(len(self.sent), len(self.records))
+
+    def test_signal_drains(self):
+        def send(key, msg):
+            if key == '5':
+                signal.raise_signal(signal.SIGINT)
+            self.sent.append(key)
+
+        handler = signal.getsignal(signal.SIGINT)
+        loop = RunLoop(self.records, self.render, send, depth=2)
+        cp = loop.run()
+        self.assertTrue(loop.stopping.is_set())
+        self.assertEqual(cp.counts['read'], len(self.sent))
+        self.assertIs(signal.getsignal(signal.SIGINT), handler)
+
+    def test_second_signal_saves(self):
+        """A second signal interrupts at once, but the messages already
+        sent are recorded"""
+
+        with NamedTemporaryFile(suffix='.checkpoint', delete=False) as fp:
+            filename = fp.name
+        remove(filename)
+
+        def send(key, msg):
+            if key == '3':
+                signal.raise_signal(signal.SIGTERM)
+                signal.raise_signal(signal.SIGTERM)
+            self.sent.append(key)
+
+        handler = signal.getsignal(signal.SIGTERM)
+        cp = Checkpoint(filename, every=10)
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                RunLoop(self.records, self.render, send, depth=2,
+                        checkpoint=cp).run()
+            self.assertIs(signal.getsignal(signal.SIGTERM), handler)
+            self.assertEqual(self.sent, ['0', '1', '2'])
+            self.assertEqual(Checkpoint(filename).last_key, '2')
+        finally:
+            remove(filename)
+
+    def test_render_error(self):
+        def render(key, record):
+            if key == '10':
+                raise ValueError(key)
+            return key
+
+        def send(key, msg):
+            sleep(0.01)
+            self.sent.append(key)
+
+        cp = Checkpoint()
+        with self.assertRaises(ValueError):
+            RunLoop(self.records, render, send, depth=2,
+                    checkpoint=cp).run()
+        self.assertTrue(all(int(key) < 10 for key in self.sent))
+        if self.sent:
+            self.assertEqual(cp.last_key, self.sent[-1])
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        with NamedTemporaryFile(mode='w', delete=False) as fp:
+            fp.write("Result: @abc@")
+            self.body = fp.name
+        with NamedTemporaryFile(suffix='.txt', delete=False) as fp:
+            self.report = fp.name
+
+    def tearDown(self):
+        remove(self.body)
+        remove(self.report)
+
+    def run_messages(self, count, limit, use_cprofile=False, dry_run=True):
+        self.messages = []
+        with Profiler(limit, self.report, use_cprofile) as prof, \
+                Sender('srv', 'me', 'pass', dry_run) as snd:
+            for i in range(count):
+                body = mailer.compose_body(self.body, {'abc': i})
+                msg = Message('me@here.com', 'you@there.net', 'test',
+                              body, '<img src="image.jpg" />',
+                              ['image.jpg'])
+                snd.send(msg)
+                self.messages.append(msg)
+        return prof
+
+    def test_limit(self):
+        prof = self.run_messages(5, 3)
+        for name in ['compose_body', 'Message.__init__',
+                     'find_images_in_html', 'flatten', 'Sender.send']:
+            self.assertEqual(prof.stats[name]['calls'], 3)
+
+    @patch('smtplib.SMTP')
+    def test_bytes(self, mock_smtp):
+        """Sender.send reports the size of the flattened messages,
+        also when they are really sent"""
+
+        for dry_run in (True, False):
+            prof = self.run_messages(3, 2, dry_run=dry_run)
+            self.assertEqual(prof.stats['compose_body']['bytes'],
+                             2 * len("Result: abc:\t0"))
+            size = sum(len(msg.as_bytes()) for msg in self.messages[:2])
+            self.assertEqual(prof.stats['Sender.send']['bytes'], size)
+            if dry_run:
+                self.assertEqual(prof.stats['flatten']['calls'], 2)
+
+    def test_keyword_message(self):
+        msg = Message('me@here.com', 'you@there.net', 'test', 'blah')
+        with Profiler(1, self.report, False) as prof, \
+                Sender('srv', 'me', 'pass', True) as snd:
+            snd.send(msg=msg)
+        self.assertEqual(prof.stats['Sender.send']['bytes'],
+                         len(msg.as_bytes()))
+
+    def test_peak(self):
+        prof = self.run_messages(2, 2)
+        for stats in prof.stats.values():
+            self.assertGreaterEqual(stats['peak'], 0)
+        self.assertGreater(prof.stats['Message.__init__']['peak'], 0)
+
+    def test_sampling_stops(self):
+        """After the first messages nothing is wrapped or traced"""
+
+        send = Sender.send
+        with Profiler(2, self.report, False) as prof, \
+                Sender('srv', 'me', 'pass', True) as snd:
+            snd.send(Message('me@here.com', 'you@there.net', 'test', 'a'))
+            self.assertTrue(tracemalloc.is_tracing())
+            snd.send(Message('me@here.com', 'you@there.net', 'test', 'b'))
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertIs(Sender.send, send)
+            snd.send(Message('me@here.com', 'you@there.net', 'test', 'c'))
+        self.assertEqual(prof.stats['Sender.send']['calls'], 2)
+
+    def test_restore(self):
+        compose = mailer.compose_body
+        init = Message.__init__
+        send = Sender.send
+        self.run_messages(1, 1)
+        self.assertIs(mailer.compose_body, compose)
+        self.assertIs(Message.__init__, init)
+        self.assertIs(Sender.send, send)
+
+    def test_report(self):
+        self.run_messages(2, 2, use_cprofile=True)
+        with open(self.report) as fp:
+            report = fp.read()
+        self.assertTrue(re.search(r"^Message.__init__ +2 ", report, re.M))
+        self.assertTrue("Top allocating call sites:" in report)
+        self.assertTrue("cProfile" in report)
+
+    def test_nothing_measured(self):
+        with Profiler(3, self.report, use_cprofile=True):
+            RunLoop([], str, str).run()
+        with open(self.report) as fp:
+            report = fp.read()
+        self.assertTrue("Top allocating call sites:" in report)
+        self.assertFalse("cProfile" in report)
+
+    def test_error_not_masked(self):
+        """An error in the run is not replaced by an error
+        from writing the report"""
+
+        with self.assertRaises(ZeroDivisionError):
+            with Profiler(3, path.join(self.report, 'missing')):
+                1 / 0
+
+    def test_disabled(self):
+        send = Sender.send
+        with Profiler(0, self.report):
+            self.assertIs(Sender.send, send)
+        with open(self.report) as fp:
+            self.assertEqual(fp.read(), "")
+
+
 if __name__ == '__main__':
     unittest.main()